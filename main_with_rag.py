@@ -1,15 +1,42 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import simsimd
+import torch
 from dotenv import load_dotenv
 from typing import Annotated, Literal, Optional
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langchain.chat_models import init_chat_model
 from pydantic import BaseModel, Field
+from sentence_transformers import SentenceTransformer
 from typing_extensions import TypedDict
 
 from langchain.schema import HumanMessage
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_huggingface import HuggingFaceEmbeddings
+
+try:
+    import sqlite_vec
+except ImportError:  # The reply cache is optional
+    sqlite_vec = None
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Use Ollama's llama3.2 model
 llm = init_chat_model("ollama:llama3.2")
 
@@ -21,15 +48,325 @@ class MessageClassifier(BaseModel):
             "logical response, or RAG (retrieval-based answer using a PDF)."
         )
     )
+    response: Optional[str] = Field(
+        None,
+        description="A direct answer to the message, filled in only when message_type is 'logical'."
+    )
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     message_type: Optional[str]
+    response: Optional[str]
 
 PDF_FILENAME = "AA.pdf"  # Path to your PDF
+PERSIST_DIRECTORY = "./pdf_index_minilm_i8"  # Where the embedded PDF chunks are cached
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+CHUNK_CACHE_DIRECTORY = "./cache"  # Split PDF chunks, keyed by PDF content hash
+RAG_PROMPT_WORD_BUDGET = 1500  # Rough cap on query + context words sent to the LLM
+EMBED_CHUNKS_PER_WORKER = 256  # Below this many chunks per process, one batched encode is faster
+
+QUERY_CACHE_DB = "query_cache.db"
+# Query embeddings are unit-length, so cosine distance d maps to L2 distance sqrt(2 * d);
+# comparing L2 avoids recomputing both norms for every cached row.
+QUERY_CACHE_MAX_DISTANCE = (2 * 0.1) ** 0.5  # Cosine distance 0.1: same question
+QUERY_CACHE_TTL = 3600  # Seconds a cached reply stays valid
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+_vectorstore = None
+_vectorstore_lock = threading.Lock()
+_query_cache = None
+_query_cache_available = True
+_query_cache_lock = threading.Lock()
+_worker_model = None  # Per-process model used by ingestion workers
+
+# Cheap keyword routes tried before asking the LLM to classify a message.
+_RAG_RE = re.compile(r"\b(pdf|document|file|attachment|AA\.pdf)\b", re.I)
+_EMOTIONAL_RE = re.compile(r"\b(feel|sad|anxious|lonely|upset|scared)\b", re.I)
+
+class BatchedHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    """Encode all documents in a single large-batch call and return a numpy array."""
+
+    def embed_documents(self, texts):
+        return self._client.encode(
+            texts,
+            batch_size=128,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+
+class QuantizedEmbeddings:
+    """
+    Wrap an embedding model so it returns int8 vectors.
+
+    The inner model must already emit unit-length vectors (normalize_embeddings=True),
+    so quantizing is a single scale and no norm is recomputed here or at search time.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @staticmethod
+    def quantize(vectors):
+        return np.round(np.asarray(vectors, dtype=np.float32) * 127).astype(np.int8)
+
+    def embed_documents(self, texts):
+        return self.quantize(self.inner.embed_documents(texts))
+
+    def embed_query(self, text):
+        return self.quantize(self.inner.embed_query(text))
+
+class PdfVectorIndex:
+    """Exact inner-product search over int8 chunk vectors, with chunk text kept in row order."""
+
+    def __init__(self, embeddings, vectors, chunks):
+        self.embeddings = embeddings
+        self.vectors = vectors
+        self.chunks = chunks
+
+    def search(self, query, k=3, query_vector=None):
+        """
+        Return the k best (chunk, score) pairs for the query, highest score first.
+        Pass query_vector (the float query embedding) to reuse an embedding already computed.
+        """
+        if not self.chunks or k <= 0:
+            return []
+        if query_vector is None:
+            query_vector = self.embeddings.embed_query(query)
+        else:
+            query_vector = self.embeddings.quantize(query_vector)
+        # One SIMD int8 dot-product pass over the whole matrix.
+        scores = np.asarray(simsimd.cdist(query_vector[None, :], self.vectors, metric="inner"))[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunks[i], float(scores[i])) for i in top]
+
+def _get_embeddings():
+    """Load the MiniLM embedding model once per process."""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                model_kwargs = {"device": "cuda" if torch.cuda.is_available() else "cpu"}
+                if model_kwargs["device"] == "cuda":
+                    # Half precision halves the matmul bytes; CPU fp16 kernels are slower than fp32, so GPU only.
+                    model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+                # MiniLM is trained on cosine-normalized outputs, so unit vectors keep scores a plain inner product.
+                _embeddings = BatchedHuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL,
+                    model_kwargs=model_kwargs,
+                    encode_kwargs={"normalize_embeddings": True, "batch_size": 64},
+                )
+    return _embeddings
+
+def _cache_key():
+    """Identify the PDF contents and ingestion settings the persisted index was built from."""
+    with open(PDF_FILENAME, "rb") as f:
+        pdf_hash = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "pdf_filename": PDF_FILENAME,
+        "pdf_sha256": pdf_hash,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "model_name": EMBEDDING_MODEL,
+    }
+
+def _load_chunks(pdf_hash):
+    """Parse and split the PDF, reusing a pickled split of the same PDF contents when available."""
+    cache_path = os.path.join(
+        CHUNK_CACHE_DIRECTORY, f"{pdf_hash[:16]}-{CHUNK_SIZE}-{CHUNK_OVERLAP}.pkl"
+    )
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning("Ignoring unreadable chunk cache %s: %s", cache_path, e)
+
+    pdf_loader = PyPDFLoader(PDF_FILENAME)
+    documents = pdf_loader.load()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = [doc.page_content for doc in text_splitter.split_documents(documents)]
+
+    # Write to a temp file and swap it in so a crash can't leave a truncated pickle behind.
+    os.makedirs(CHUNK_CACHE_DIRECTORY, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(chunks, f)
+    os.replace(tmp_path, cache_path)
+    return chunks
+
+def _init_embedding_worker():
+    global _worker_model
+    # One intra-op thread per worker process so the pool doesn't oversubscribe the cores.
+    torch.set_num_threads(1)
+    _worker_model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
+def _encode_shard(texts):
+    return _worker_model.encode(
+        texts,
+        batch_size=64,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
+
+def _embed_chunks(chunks):
+    """
+    Embed PDF chunks for ingestion. Large PDFs on CPU-only hosts are sharded across
+    processes; each worker reloads the model, so small PDFs use one batched encode.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    workers = min(cores, len(chunks) // EMBED_CHUNKS_PER_WORKER)
+    if torch.cuda.is_available() or workers <= 1:
+        return _get_embeddings().embed_documents(chunks)
+
+    shard_size = -(-len(chunks) // workers)
+    shards = [chunks[i:i + shard_size] for i in range(0, len(chunks), shard_size)]
+    # Spawn rather than fork: this process already runs torch thread pools.
+    with ProcessPoolExecutor(
+        max_workers=len(shards),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_embedding_worker,
+    ) as pool:
+        return np.vstack(list(pool.map(_encode_shard, shards)))
+
+def _load_vectorstore():
+    key = _cache_key()
+    meta_path = os.path.join(PERSIST_DIRECTORY, "meta.json")
+    vectors_path = os.path.join(PERSIST_DIRECTORY, "vectors.npy")
+    chunks_path = os.path.join(PERSIST_DIRECTORY, "chunks.json")
+    embeddings = QuantizedEmbeddings(_get_embeddings())
+
+    # Reuse the persisted index if it was built from the same PDF and settings.
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == key:
+                with open(chunks_path) as chunks_file:
+                    chunks = json.load(chunks_file)
+                # An empty index can only come from an older build; rebuild so it raises below.
+                if chunks:
+                    return PdfVectorIndex(embeddings, np.load(vectors_path), chunks)
+
+    chunks = _load_chunks(key["pdf_sha256"])
+    if not chunks:
+        raise ValueError(f"No text could be extracted from {PDF_FILENAME}")
+    vectors = embeddings.quantize(_embed_chunks(chunks))
+
+    os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+    np.save(vectors_path, vectors)
+    with open(chunks_path, "w") as f:
+        json.dump(chunks, f)
+    with open(meta_path, "w") as f:
+        json.dump(key, f)
+    return PdfVectorIndex(embeddings, vectors, chunks)
+
+def _get_vectorstore():
+    """Build (or reopen) the PDF vector index once per process."""
+    global _vectorstore
+    if _vectorstore is None:
+        with _vectorstore_lock:
+            if _vectorstore is None:
+                _vectorstore = _load_vectorstore()
+    return _vectorstore
+
+def _get_query_cache():
+    """
+    Open the sqlite-vec backed reply cache, or return None if it can't be opened
+    (e.g. a Python build without loadable SQLite extensions); callers must hold _query_cache_lock.
+    """
+    global _query_cache, _query_cache_available
+    if _query_cache is None and _query_cache_available:
+        try:
+            if sqlite_vec is None:
+                raise RuntimeError("sqlite-vec is not installed")
+            conn = sqlite3.connect(QUERY_CACHE_DB, check_same_thread=False)
+            conn.enable_load_extension(True)
+            sqlite_vec.load(conn)
+            conn.enable_load_extension(False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache (route TEXT, embedding BLOB, response TEXT, ts INTEGER)"
+            )
+            conn.commit()
+            _query_cache = conn
+        except Exception as e:
+            logger.warning("Reply cache disabled: %s", e)
+            _query_cache_available = False
+    return _query_cache
+
+def write_reply(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def stream_reply(messages):
+    """Write the LLM reply to stdout as tokens arrive and return the full text."""
+    chunks = []
+    for chunk in llm.stream(messages):
+        chunks.append(chunk.content)
+        write_reply(chunk.content)
+    return "".join(chunks)
+
+def invoke_cached(route, query, messages, no_cache=False, query_vector=None):
+    """
+    Stream the LLM reply for messages and return it, reusing a recent reply on the
+    same route when the query is semantically near-identical to one already answered.
+    The cache is best effort: if it is unavailable or fails, the LLM is called directly.
+    """
+    if no_cache:
+        return stream_reply(messages)
+
+    now = int(time.time())
+    conn = row = None
+    try:
+        with _query_cache_lock:
+            conn = _get_query_cache()
+        if conn is not None:
+            if query_vector is None:
+                query_vector = _get_embeddings().embed_query(query)
+            embedding = np.asarray(query_vector, dtype=np.float32).tobytes()
+            with _query_cache_lock:
+                row = conn.execute(
+                    "SELECT response FROM query_cache "
+                    "WHERE route = ? AND ts > ? AND vec_distance_l2(embedding, ?) < ? "
+                    "ORDER BY vec_distance_l2(embedding, ?) LIMIT 1",
+                    (route, now - QUERY_CACHE_TTL, embedding, QUERY_CACHE_MAX_DISTANCE, embedding),
+                ).fetchone()
+    except Exception as e:
+        logger.warning("Reply cache lookup failed: %s", e)
+        conn = None
+    if row:
+        write_reply(row[0])
+        return row[0]
+
+    response = stream_reply(messages)
+    if conn is None:
+        return response
+    try:
+        with _query_cache_lock:
+            conn.execute("DELETE FROM query_cache WHERE ts <= ?", (now - QUERY_CACHE_TTL,))
+            conn.execute(
+                "INSERT INTO query_cache (route, embedding, response, ts) VALUES (?, ?, ?, ?)",
+                (route, embedding, response, now),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.warning("Reply cache update failed: %s", e)
+    return response
 
 def classify_message(state: State):
     last_message = state["messages"][-1]
+    if _RAG_RE.search(last_message.content):
+        return {"message_type": "rag", "response": None}
+    if _EMOTIONAL_RE.search(last_message.content):
+        return {"message_type": "emotional", "response": None}
+
     classifier_llm = llm.with_structured_output(MessageClassifier)
     result = classifier_llm.invoke([
         {
@@ -40,11 +377,15 @@ def classify_message(state: State):
                 "- 'logical': if it asks for facts, logical analysis, or practical solutions.\n"
                 "- 'rag': if it requests information from a document (e.g., mentions 'pdf' or 'document') "
                 "or requires retrieval-based generation.\n"
+                "If message_type is 'logical', also fill 'response' with a clear, concise, "
+                "direct answer to the message. Otherwise leave 'response' empty.\n"
             )
         },
         {"role": "user", "content": last_message.content}
     ])
-    return {"message_type": result.message_type}
+    # Only logical answers are reused; the other routes need their own prompt or retrieval.
+    response = result.response if result.message_type == "logical" else None
+    return {"message_type": result.message_type, "response": response}
 
 def router(state: State):
     message_type = state.get("message_type", "logical")
@@ -52,8 +393,15 @@ def router(state: State):
         return {"next": "therapist"}
     elif message_type == "rag":
         return {"next": "rag"}
+    if state.get("response"):
+        return {"next": "direct"}
     return {"next": "logical"}
 
+def direct_reply(state: State):
+    """Emit the answer the classifier already produced, skipping a second LLM call."""
+    write_reply(state["response"])
+    return {"messages": [{"role": "assistant", "content": state["response"]}]}
+
 def therapist_agent(state: State):
     last_message = state["messages"][-1]
     messages = [
@@ -67,8 +415,9 @@ def therapist_agent(state: State):
          },
         {"role": "user", "content": last_message.content}
     ]
-    reply = llm.invoke(messages)
-    return {"messages": [{"role": "assistant", "content": reply.content}]}
+    # Replies to feelings should be written fresh, never recycled.
+    reply = invoke_cached("therapist", last_message.content, messages, no_cache=True)
+    return {"messages": [{"role": "assistant", "content": reply}]}
 
 def logical_agent(state: State):
     last_message = state["messages"][-1]
@@ -83,30 +432,29 @@ def logical_agent(state: State):
          },
         {"role": "user", "content": last_message.content}
     ]
-    reply = llm.invoke(messages)
-    return {"messages": [{"role": "assistant", "content": reply.content}]}
+    reply = invoke_cached("logical", last_message.content, messages)
+    return {"messages": [{"role": "assistant", "content": reply}]}
 
 def rag_agent(state: State):
-    from langchain_community.document_loaders import PyPDFLoader
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-    from langchain_huggingface import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import Chroma
-
     last_message = state["messages"][-1]
     user_query = last_message.content
 
     try:
-        pdf_loader = PyPDFLoader(PDF_FILENAME)
-        documents = pdf_loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        docs = text_splitter.split_documents(documents)
-        embeddings = HuggingFaceEmbeddings(model_name="all-mpnet-base-v2")
-        vectorstore = Chroma.from_documents(docs, embeddings, collection_name="pdf_docs")
+        vectorstore = _get_vectorstore()
     except Exception as e:
-        return {"messages": [{"role": "assistant", "content": f"RAG initialization failed: {e}"}]}
+        reply = f"RAG initialization failed: {e}"
+        write_reply(reply)
+        return {"messages": [{"role": "assistant", "content": reply}]}
 
-    retrieved_docs = vectorstore.similarity_search(user_query, k=3)
-    context = "\n".join([doc.page_content for doc in retrieved_docs])
+    # Chunks come back best first; drop the weakest until the prompt fits the budget.
+    # Embed the query once for both retrieval and the reply cache.
+    query_vector = _get_embeddings().embed_query(user_query)
+    retrieved_chunks = vectorstore.search(user_query, k=3, query_vector=query_vector)
+    word_count = len(user_query.split()) + sum(len(chunk.split()) for chunk, _ in retrieved_chunks)
+    while len(retrieved_chunks) > 1 and word_count > RAG_PROMPT_WORD_BUDGET:
+        chunk, _ = retrieved_chunks.pop()
+        word_count -= len(chunk.split())
+    context = "\n".join(chunk for chunk, _ in retrieved_chunks)
 
     prompt = (
         f"Using the context below extracted from a document:\n\n"
@@ -119,8 +467,8 @@ def rag_agent(state: State):
         {"role": "system", "content": "You are an assistant that uses document context to provide answers."},
         {"role": "user", "content": prompt}
     ]
-    reply = llm.invoke(messages)
-    return {"messages": [{"role": "assistant", "content": reply.content}]}
+    reply = invoke_cached("rag", user_query, messages, query_vector=query_vector)
+    return {"messages": [{"role": "assistant", "content": reply}]}
 
 # Graph construction
 graph_builder = StateGraph(State)
@@ -129,30 +477,33 @@ graph_builder.add_node("router", router)
 graph_builder.add_node("therapist", therapist_agent)
 graph_builder.add_node("logical", logical_agent)
 graph_builder.add_node("rag", rag_agent)
+graph_builder.add_node("direct", direct_reply)
 
 graph_builder.add_edge(START, "classifier")
 graph_builder.add_edge("classifier", "router")
 graph_builder.add_conditional_edges(
     "router",
     lambda state: state.get("next"),
-    {"therapist": "therapist", "logical": "logical", "rag": "rag"}
+    {"therapist": "therapist", "logical": "logical", "rag": "rag", "direct": "direct"}
 )
 graph_builder.add_edge("therapist", END)
 graph_builder.add_edge("logical", END)
 graph_builder.add_edge("rag", END)
+graph_builder.add_edge("direct", END)
 graph = graph_builder.compile()
 
 def run_chatbot():
-    state = {"messages": [], "message_type": None}
+    state = {"messages": [], "message_type": None, "response": None}
     while True:
         user_input = input("Message: ")
         if user_input.lower() == "exit":
             print("Bye!")
             break
         state["messages"].append(HumanMessage(content=user_input))
+        # The agents stream their reply to stdout, so only the prefix and newline are printed here.
+        print("Assistant: ", end="", flush=True)
         state = graph.invoke(state)
-        if state.get("messages"):
-            print(f"Assistant: {state['messages'][-1].content}")
+        print()
 
 if __name__ == "__main__":
     run_chatbot()
@@ -1,18 +1,31 @@
+import io
 import os
+import re
 import time
-import json
 import email
+import binascii
+import asyncio
+import logging
 import sqlite3
 import threading
+import orjson
 from email.message import EmailMessage
 from aiosmtpd.controller import Controller
-from flask import Flask, render_template_string, request, redirect, url_for
+from flask import Flask, g, request, redirect, url_for
 from flask_httpauth import HTTPBasicAuth
+from waitress import serve
 import smtplib
 
 # Constants and directories
 DB_FILE = "emails.db"
 ATTACHMENTS_DIR = "attachments"
+INSERT_BATCH_SIZE = 50  # Max emails written per transaction
+INSERT_BATCH_INTERVAL = 0.2  # Seconds to wait for more emails before writing a batch
+INSERT_RETRY_DELAY = 1.0  # Seconds to wait before retrying a batch whose write failed
+INBOX_PAGE_SIZE = 100  # Emails shown per inbox page
+MAX_INBOX_PAGE = (2**63 - 1) // INBOX_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
 
 if not os.path.exists(ATTACHMENTS_DIR):
     os.makedirs(ATTACHMENTS_DIR)
@@ -21,11 +34,25 @@ if not os.path.exists(ATTACHMENTS_DIR):
 # Database functions to persist emails. #
 #########################################
 
+_local = threading.local()
+_write_lock = threading.Lock()
+
+def get_db():
+    """Return this thread's SQLite connection, opening it in WAL mode on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        # WAL lets the web UI read while the SMTP handler writes; NORMAL sync is safe under WAL.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        _local.conn = conn
+    return conn
+
 def init_db():
     """Initialize the SQLite database and create table if needed."""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''
+    get_db().execute('''
         CREATE TABLE IF NOT EXISTS emails (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             sender TEXT,
@@ -36,20 +63,41 @@ def init_db():
             attachments TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
-
-def save_email_to_db(sender, recipients, subject, body, date_str, attachments):
-    """Save the email data to the database."""
-    attachments_json = json.dumps(attachments)
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO emails (sender, recipients, subject, body, date, attachments)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (sender, recipients, subject, body, date_str, attachments_json))
-    conn.commit()
-    conn.close()
+
+def save_emails_to_db(emails):
+    """Save a batch of (sender, recipients, subject, body, date, attachments) tuples in one transaction."""
+    rows = [
+        (sender, recipients, subject, body, date_str, orjson.dumps(attachments).decode())
+        for sender, recipients, subject, body, date_str, attachments in emails
+    ]
+    with _write_lock:
+        conn = get_db()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany('''
+                INSERT INTO emails (sender, recipients, subject, body, date, attachments)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def save_emails_one_by_one(emails):
+    """
+    Save emails individually after a batch write failed. Emails that can never be
+    stored are logged and dropped; ones that hit a transient error (e.g. a locked
+    database) are returned so they can be retried.
+    """
+    retry = []
+    for email_row in emails:
+        try:
+            save_emails_to_db([email_row])
+        except sqlite3.OperationalError:
+            retry.append(email_row)
+        except Exception:
+            logger.exception("Dropping email from %s that could not be stored", email_row[0])
+    return retry
 
 init_db()
 
@@ -57,7 +105,107 @@ init_db()
 # SMTP Server Handler                   #
 #########################################
 
+_BASE64_NOISE_RE = re.compile(rb"[^A-Za-z0-9+/=]")
+
+def _decode_base64_lines(raw, f):
+    """
+    Decode base64 text into f line by line. Lines may be wrapped at any width,
+    so incomplete 4-character groups are carried over to the next line.
+    """
+    leftover = b""
+    for line in io.BytesIO(raw):
+        data = leftover + _BASE64_NOISE_RE.sub(b"", line)
+        cut = len(data) - len(data) % 4
+        f.write(binascii.a2b_base64(data[:cut]))
+        leftover = data[cut:]
+    if len(leftover) > 1:
+        # Pad a truncated final group the way the email package does.
+        f.write(binascii.a2b_base64(leftover + b"=" * (-len(leftover) % 4)))
+
+def save_attachment(part, filepath):
+    """
+    Write an attachment part to disk. Base64 payloads are decoded line by line
+    straight into the file instead of into one large bytes object first.
+    """
+    try:
+        with open(filepath, "wb") as f:
+            if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+                raw = part.get_payload(decode=False)
+                if isinstance(raw, str):
+                    # Characters outside the base64 alphabet are skipped by the decoder anyway.
+                    raw = raw.encode("ascii", errors="ignore")
+                try:
+                    _decode_base64_lines(raw, f)
+                    return
+                except binascii.Error:
+                    # Fall back to the email package's more lenient decoder.
+                    f.seek(0)
+                    f.truncate()
+            f.write(part.get_payload(decode=True))
+    except Exception:
+        # Don't leave a partial file behind.
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise
+
 class EmailHandler:
+    def __init__(self):
+        # Created on first delivery, inside the controller's event loop.
+        self._queue = None
+        self._writer = None
+
+    def _enqueue(self, email_row):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        # Restart the writer if it ever exits, so accepted emails are never stranded in the queue.
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_batches())
+        self._queue.put_nowait(email_row)
+
+    async def _write_batches(self):
+        """
+        Drain queued emails into the database, committing up to INSERT_BATCH_SIZE
+        at a time or whatever arrived within INSERT_BATCH_INTERVAL.
+        """
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                if not batch:
+                    batch.append(await self._queue.get())
+                deadline = loop.time() + INSERT_BATCH_INTERVAL
+                while len(batch) < INSERT_BATCH_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                pending, batch = batch, []
+                try:
+                    await loop.run_in_executor(None, save_emails_to_db, pending)
+                except Exception:
+                    # Isolate bad rows so one email can't block the rest, then retry the
+                    # transient failures (topped up with newer emails) after a pause.
+                    logger.exception("Failed to write %d email(s) as a batch; writing them one at a time", len(pending))
+                    batch = await loop.run_in_executor(None, save_emails_one_by_one, pending)
+                    if batch:
+                        await asyncio.sleep(INSERT_RETRY_DELAY)
+                    continue
+                logger.debug("Wrote %d email(s) to the database", len(pending))
+        finally:
+            # Flush emails already accepted when the controller shuts the loop down.
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if batch:
+                try:
+                    save_emails_to_db(batch)
+                except Exception:
+                    failed = save_emails_one_by_one(batch)
+                    if failed:
+                        logger.error("Failed to write %d email(s) at shutdown", len(failed))
+
     async def handle_DATA(self, server, session, envelope):
         """
         This method is called whenever an email is received.
@@ -66,19 +214,22 @@ class EmailHandler:
         try:
             msg = email.message_from_bytes(envelope.content)
         except Exception as e:
-            print("Error parsing message:", e)
+            logger.error("Error parsing message: %s", e)
             return "550 Error"
         
         # Extract header details.
-        sender = msg.get("From", envelope.mail_from)
-        recipients = msg.get("To", ", ".join(envelope.rcpt_tos))
-        subject = msg.get("Subject", "(No Subject)")
-        date_str = msg.get("Date", time.strftime("%Y-%m-%d %H:%M:%S"))
+        # Headers with raw 8-bit bytes come back as email.header.Header, which SQLite can't bind.
+        sender = str(msg.get("From", envelope.mail_from))
+        recipients = str(msg.get("To", ", ".join(envelope.rcpt_tos)))
+        subject = str(msg.get("Subject", "(No Subject)"))
+        date_str = str(msg.get("Date", time.strftime("%Y-%m-%d %H:%M:%S")))
 
         body = ""
         attachments = []
 
         if msg.is_multipart():
+            # Collect text parts and join once; repeated += on a str is quadratic.
+            body_parts = []
             for part in msg.walk():
                 content_disposition = part.get("Content-Disposition", "")
                 # Skip container multipart parts.
@@ -89,17 +240,17 @@ class EmailHandler:
                     filename = part.get_filename()
                     if filename:
                         filepath = os.path.join(ATTACHMENTS_DIR, filename)
-                        with open(filepath, "wb") as f:
-                            f.write(part.get_payload(decode=True))
+                        save_attachment(part, filepath)
                         attachments.append(filepath)
                 else:
                     # Otherwise, extract the textual content.
                     payload = part.get_payload(decode=True)
                     if payload:
                         try:
-                            body += payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+                            body_parts.append(payload.decode(part.get_content_charset() or "utf-8", errors="replace"))
                         except Exception as e:
-                            body += str(payload)
+                            body_parts.append(str(payload))
+            body = "".join(body_parts)
         else:
             payload = msg.get_payload(decode=True)
             if payload:
@@ -108,16 +259,16 @@ class EmailHandler:
                 except Exception as e:
                     body = str(payload)
 
-        # Persist the email in the database.
-        save_email_to_db(sender, recipients, subject, body, date_str, attachments)
-        print(f"Saved email from {sender} with subject '{subject}'")
+        # Queue the email for the next batched database write.
+        self._enqueue((sender, recipients, subject, body, date_str, attachments))
+        logger.info("Accepted email from %s with subject '%s'", sender, subject)
         return "250 Message accepted for delivery"
 
 def run_smtp_server():
     """Start the SMTP server (using aiosmtpd) in the background."""
     controller = Controller(EmailHandler(), hostname="localhost", port=1025)
     controller.start()
-    print("SMTP server running on localhost:1025")
+    logger.info("SMTP server running on localhost:1025")
     return controller
 
 #########################################
@@ -175,6 +326,10 @@ TEMPLATE = """
         </li>
       {% endfor %}
       </ul>
+      <p>
+        {% if page > 1 %}<a href="?page={{ page - 1 }}">Newer</a>{% endif %}
+        {% if has_next %}<a href="?page={{ page + 1 }}">Older</a>{% endif %}
+      </p>
     {% else %}
       <p>No emails found.</p>
     {% endif %}
@@ -199,20 +354,33 @@ TEMPLATE = """
 </html>
 """
 
+# Compile the template once at import instead of on every request.
+INBOX_TEMPLATE = app.jinja_env.from_string(TEMPLATE)
+
+@app.before_request
+def open_db():
+    """Reuse the serving thread's connection instead of reconnecting per request."""
+    g.db = get_db()
+
 @app.route("/")
 @auth.login_required
 def inbox():
-    """Render the inbox by querying emails from the database."""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT sender, recipients, subject, body, date, attachments FROM emails ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
+    """Render one page of the inbox by querying emails from the database."""
+    # Keep OFFSET within SQLite's signed 64-bit INTEGER range.
+    page = min(max(request.args.get("page", 1, type=int), 1), MAX_INBOX_PAGE)
+    # Fetch one extra row to know whether an older page exists.
+    rows = g.db.execute(
+        "SELECT sender, recipients, subject, body, date, attachments FROM emails "
+        "ORDER BY id DESC LIMIT ? OFFSET ?",
+        (INBOX_PAGE_SIZE + 1, (page - 1) * INBOX_PAGE_SIZE),
+    ).fetchall()
+    has_next = len(rows) > INBOX_PAGE_SIZE
+    rows = rows[:INBOX_PAGE_SIZE]
     
     emails = []
     for row in rows:
         sender, recipients, subject, body, date_str, attachments_json = row
-        attachments = json.loads(attachments_json) if attachments_json else []
+        attachments = orjson.loads(attachments_json) if attachments_json else []
         emails.append({
             "sender": sender,
             "recipients": recipients,
@@ -222,7 +390,7 @@ def inbox():
             "attachments": attachments,
         })
         
-    return render_template_string(TEMPLATE, emails=emails)
+    return INBOX_TEMPLATE.render(emails=emails, page=page, has_next=has_next)
 
 @app.route("/send", methods=["POST"])
 @auth.login_required
@@ -245,24 +413,26 @@ def send_email():
     try:
         with smtplib.SMTP("localhost", 1025) as smtp:
             smtp.send_message(msg)
-        print(f"Sent email from {email_from} to {email_to}")
+        logger.info("Sent email from %s to %s", email_from, email_to)
     except Exception as e:
-        print("Error sending email:", e)
+        logger.error("Error sending email: %s", e)
     return redirect(url_for("inbox"))
 
 def run_flask_app():
-    print("Flask web server running on http://localhost:5000")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    logger.info("Flask web server running on http://localhost:5000")
+    # Waitress serves from a fixed thread pool, so each thread keeps its SQLite connection.
+    serve(app, host="0.0.0.0", port=5000, threads=8)
 
 #########################################
 # Entry Point                           #
 #########################################
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     # Start the SMTP server (background thread).
     smtp_controller = run_smtp_server()
     try:
         run_flask_app()
     finally:
         smtp_controller.stop()
-        print("SMTP server stopped.")
+        logger.info("SMTP server stopped.")